@@ -24,11 +24,49 @@ def get_args():
     )
     parser.add_argument(
         "--rtmp-stream-url",
-        required=True,
-        help="the location to stream downloaded files to, i.e. rtmp://localhost/stream/live"
+        help="the location to stream downloaded files to, i.e. rtmp://localhost/stream/live. required unless --hls is given"
     )
     parser.add_argument(
         "--cache-state-file",
-        help="JSON file to persist cache state on server shutdown and recover on startup. if specified, the server will not empty the cache on shutdown"
+        help="JSON file to persist cache state on server shutdown and recover on startup. if specified, the server will not empty the cache on shutdown. playback positions are saved next to it as <name>.positions.json while videos play"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--hls",
+        action="store_true",
+        help="also write the stream as HLS and serve it under /hls/index.m3u8"
+    )
+    parser.add_argument(
+        "--hls-dir",
+        help="directory to write HLS segments to, defaults to a directory in /dev/shm"
+    )
+    parser.add_argument(
+        "--hls-segment-seconds",
+        type=int,
+        help="target length of each HLS segment, defaults to 4",
+        default=4
+    )
+    parser.add_argument(
+        "--hls-list-size",
+        type=int,
+        help="number of segments kept in the HLS playlist, defaults to 6",
+        default=6
+    )
+    parser.add_argument(
+        "--debug-token",
+        help="token required in the Authorization header to use the /debug/profile endpoints. if not specified, the endpoints are disabled"
+    )
+    parser.add_argument(
+        "--profile-max-seconds",
+        type=int,
+        help="longest sampling window accepted by /debug/profile, defaults to 60",
+        default=60
+    )
+    parser.add_argument(
+        "--reload",
+        action="store_true",
+        help="restart the server when source files change, for local development"
+    )
+    args = parser.parse_args()
+    if args.rtmp_stream_url is None and not args.hls:
+        parser.error("--rtmp-stream-url is required unless --hls is given")
+    return args
@@ -1,12 +1,12 @@
 from collections import OrderedDict
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 import logging
 import os
+import threading
 import uuid
 import json
 
-from pytubefix import YouTube
-
+from modules.media import MediaInfo, probe_media
 from modules.metrics import MetricsHandler
 from urllib.parse import urlparse, parse_qs
 
@@ -17,11 +17,19 @@ class VideoInfo:
     thumbnail: str
     title: str
     size_bytes: int
+    media: MediaInfo = None
+    # where playback of this video was last interrupted
+    position_seconds: float = 0
 
     def __str__(self):
         return f"VideoInfo(video_id={self.video_id}, file_path={self.file_path}, size_bytes={self.size_bytes})"
 
 
+# a download that turns out corrupt or truncated is fetched again this many
+# times in total before giving up
+MAX_DOWNLOAD_ATTEMPTS = 2
+
+
 class Cache:
     def __init__(
         self,
@@ -33,9 +41,27 @@ class Cache:
         self.max_size_bytes = max_size_bytes
         self.current_size_bytes = 0
         self.cache_file = cache_file
+        # playback positions change every few seconds while a video plays, so
+        # they are kept in a small file of their own next to the cache file
+        self.positions_file = None
+        if self.cache_file is not None:
+            self.positions_file = (
+                os.path.splitext(self.cache_file)[0] + ".positions.json"
+            )
+        self.written_positions = None
         self.video_id_to_path = OrderedDict()
+        # guards video_id_to_path and current_size_bytes, which are used from
+        # request handlers, stream threads and background reconciliation
+        self.lock = threading.RLock()
+        # set once the cache file has been read, the cache can be used before
+        # then but shouldn't be written back to the file
+        self.loaded = threading.Event()
+        if self.cache_file is None:
+            self.loaded.set()
 
     def add(self, url: str):
+        from pytubefix import YouTube
+
         video = YouTube(url)
         # Download video of set resolution
         video = (
@@ -52,17 +78,43 @@ class Cache:
                 f"Video size ({video.filesize} bytes) exceeds max cache size ({self.max_size_bytes} bytes). Caching cancelled."
             )
             return None
-        if self.current_size_bytes + video.filesize > self.max_size_bytes:
-            target_bytes = self.max_size_bytes - video.filesize
-            self._downsize_cache_to_target_bytes(target_bytes)
+        with self.lock:
+            if self.current_size_bytes + video.filesize > self.max_size_bytes:
+                target_bytes = self.max_size_bytes - video.filesize
+                self._downsize_cache_to_target_bytes(target_bytes)
+                MetricsHandler.cache_size.set(len(self.video_id_to_path))
+                MetricsHandler.cache_size_bytes.set(self.current_size_bytes)
+        video_id = self.get_video_id(url)
+        for _ in range(MAX_DOWNLOAD_ATTEMPTS):
+            video_file_path = self._download(url, video)
+            # probe once at ingest so nobody has to find out at play time
+            media = probe_media(video_file_path)
+            if media is None or media.is_valid:
+                break
+            logging.warning(
+                f"{video_file_path} downloaded from {url} is corrupt, removing it"
+            )
+            os.remove(video_file_path)
+        else:
+            return None
+        video_info = VideoInfo(
+            file_path=video_file_path,
+            thumbnail=YouTube(url).thumbnail_url,
+            title=YouTube(url).title,
+            size_bytes=video.filesize,
+            media=media,
+        )
+        with self.lock:
+            self.video_id_to_path[video_id] = video_info
+            self.current_size_bytes += video_info.size_bytes
             MetricsHandler.cache_size.set(len(self.video_id_to_path))
             MetricsHandler.cache_size_bytes.set(self.current_size_bytes)
-        video_file_name = video.default_filename
+
+    def _download(self, url: str, video) -> str:
         with MetricsHandler.download_time.time():
             video.download(self.file_path)
         MetricsHandler.data_downloaded.inc(video.filesize)
         MetricsHandler.video_download_count.inc()
-        video_id = self.get_video_id(url)
         video_file_name = str(uuid.uuid4()) + ".mp4"
         video_file_path = os.path.join(self.file_path, video_file_name)
         os.rename(
@@ -70,33 +122,103 @@ class Cache:
             video_file_path,
         )
         logging.info(f"downloaded {url} to path {video_file_path}")
-        video_info = VideoInfo(
-            file_path=video_file_path,
-            thumbnail=YouTube(url).thumbnail_url,
-            title=YouTube(url).title,
-            size_bytes=video.filesize,
-        )
-        self.video_id_to_path[video_id] = video_info
-        self.current_size_bytes += video_info.size_bytes
-        MetricsHandler.cache_size.set(len(self.video_id_to_path))
-        MetricsHandler.cache_size_bytes.set(self.current_size_bytes)
+        return video_file_path
 
     def find(self, video_id: str):
-        if video_id in self.video_id_to_path:
-            self.video_id_to_path.move_to_end(video_id)
-            MetricsHandler.cache_hit_count.inc()
-            return self.video_id_to_path[video_id].file_path
+        with self.lock:
+            if video_id in self.video_id_to_path:
+                self.video_id_to_path.move_to_end(video_id)
+                MetricsHandler.cache_hit_count.inc()
+                return self.video_id_to_path[video_id].file_path
         MetricsHandler.cache_miss_count.inc()
         return None
 
-    def _downsize_cache_to_target_bytes(self, target_bytes: int):
-        logging.info(
-            f"current size {self.current_size_bytes}, downsizing to {target_bytes}"
-        )
-        while self.current_size_bytes > target_bytes:
-            removed_video_info = self.video_id_to_path.popitem(last=False)[1]
+    def find_by_path(self, file_path: str):
+        for video_info in self.get_items().values():
+            if video_info.file_path == file_path:
+                return video_info
+        return None
+
+    # a snapshot of the cache that is safe to iterate while other threads
+    # add or remove videos
+    def get_items(self) -> OrderedDict:
+        with self.lock:
+            return OrderedDict(self.video_id_to_path)
+
+    def _remove(self, video_id: str):
+        with self.lock:
+            removed_video_info = self.video_id_to_path.pop(video_id, None)
+            if removed_video_info is None:
+                return
             self.current_size_bytes -= removed_video_info.size_bytes
-            os.remove(removed_video_info.file_path)
+            self._remove_file(removed_video_info.file_path)
+            MetricsHandler.cache_size.set(len(self.video_id_to_path))
+            MetricsHandler.cache_size_bytes.set(self.current_size_bytes)
+
+    # the file may have been deleted outside the server, which is fine since
+    # we were about to delete it anyway
+    @staticmethod
+    def _remove_file(file_path: str):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            logging.info(f"{file_path} was already removed")
+
+    # make sure a cached video is playable before it is streamed, probing it
+    # now if reconciliation hasn't reached it yet. a corrupt video is removed
+    # from the cache and False is returned
+    def ensure_valid(self, video_id: str) -> bool:
+        video_info = self.get_items().get(video_id)
+        if video_info is None:
+            return False
+        if video_info.media is None:
+            video_info.media = probe_media(video_info.file_path)
+        # if ffprobe can't run we know nothing, so let ffmpeg try
+        if video_info.media is None or video_info.media.is_valid:
+            return True
+        logging.warning(f"{video_info.file_path} is corrupt, removing it")
+        self._remove(video_id)
+        return False
+
+    def get_video_id_by_path(self, file_path: str):
+        for video_id, video_info in self.get_items().items():
+            if video_info.file_path == file_path:
+                return video_id
+        return None
+
+    # probe entries that were cached before they could be probed at ingest,
+    # i.e. ones read from an older cache file, or probed before keyframes were
+    # indexed. corrupt or truncated files are fetched again so they are fixed
+    # before anyone tries to play them
+    def probe_unindexed(self):
+        for video_id, video_info in self.get_items().items():
+            if (
+                video_info.media is not None
+                and video_info.media.keyframe_times is not None
+            ):
+                continue
+            media = probe_media(video_info.file_path)
+            if media is None:
+                continue
+            video_info.media = media
+            if media.is_valid:
+                continue
+            logging.warning(f"{video_info.file_path} is corrupt, fetching it again")
+            try:
+                self._remove(video_id)
+                self.add(self.get_video_url(video_id))
+            except Exception:
+                logging.exception(f"unable to fetch {video_id} again")
+
+    def _downsize_cache_to_target_bytes(self, target_bytes: int):
+        with self.lock:
+            logging.info(
+                f"current size {self.current_size_bytes}, downsizing to {target_bytes}"
+            )
+            while self.current_size_bytes > target_bytes:
+                removed_video_info = self.video_id_to_path.popitem(last=False)[1]
+                self.current_size_bytes -= removed_video_info.size_bytes
+                self._remove_file(removed_video_info.file_path)
 
     def clear(self):
         self._downsize_cache_to_target_bytes(0)
@@ -114,31 +236,59 @@ class Cache:
                 if not os.path.exists(video_info["file_path"]):
                     logging.info(f"{video_info['file_path']} was not found on disk")
                     continue
-                self.video_id_to_path[video_key] = VideoInfo(
-                    file_path=video_info["file_path"],
-                    thumbnail=video_info["thumbnail"],
-                    title=video_info["title"],
-                    size_bytes=video_info["size_bytes"],
-                )
-                self.current_size_bytes += video_info["size_bytes"]
-                MetricsHandler.cache_size.set(len(self.video_id_to_path))
-                MetricsHandler.cache_size_bytes.set(self.current_size_bytes)
+                with self.lock:
+                    # the cache is read in the background while requests are
+                    # served, so a video may have been downloaded again in the
+                    # meantime. keep that copy and drop the old file
+                    cached_video_info = self.video_id_to_path.get(video_key)
+                    if cached_video_info is not None:
+                        if cached_video_info.file_path != video_info["file_path"]:
+                            os.remove(video_info["file_path"])
+                        continue
+                    self.video_id_to_path[video_key] = VideoInfo(
+                        file_path=video_info["file_path"],
+                        thumbnail=video_info["thumbnail"],
+                        title=video_info["title"],
+                        size_bytes=video_info["size_bytes"],
+                        media=(
+                            MediaInfo(**video_info["media"])
+                            if video_info.get("media")
+                            else None
+                        ),
+                    )
+                    self.current_size_bytes += video_info["size_bytes"]
+                    MetricsHandler.cache_size.set(len(self.video_id_to_path))
+                    MetricsHandler.cache_size_bytes.set(self.current_size_bytes)
             logging.info(
                 f"Read {len(self.video_id_to_path)} items from cache file {self.cache_file}"
             )
+            self._read_positions()
         except Exception:
             logging.exception(f"unable to read cache data from {self.cache_file}")
+        finally:
+            self.loaded.set()
+
+    def _read_positions(self):
+        if not os.path.exists(self.positions_file):
+            return
+        with open(self.positions_file, "r") as f:
+            positions = json.load(f)
+        with self.lock:
+            for video_id, position_seconds in positions.items():
+                if video_id in self.video_id_to_path:
+                    self.video_id_to_path[video_id].position_seconds = position_seconds
 
     def write_cache(self):
         try:
             # cache state
             cache_state = {}
-            for video_id, video_info in self.video_id_to_path.items():
+            for video_id, video_info in self.get_items().items():
                 cache_state[video_id] = {
                     "file_path": video_info.file_path,
                     "thumbnail": video_info.thumbnail,
                     "title": video_info.title,
                     "size_bytes": video_info.size_bytes,
+                    "media": asdict(video_info.media) if video_info.media else None,
                 }
 
             # serializing json
@@ -151,11 +301,39 @@ class Cache:
             logging.info(
                 f"Wrote {len(cache_state)} items to cache file {self.cache_file}"
             )
+            self.write_positions()
         except Exception:
             logging.exception(f"unable to write cache data to {self.cache_file}")
 
+    # called every few seconds while a video plays, so the file is only
+    # written when a position actually changed
+    def write_positions(self):
+        try:
+            positions = {
+                video_id: video_info.position_seconds
+                for video_id, video_info in self.get_items().items()
+                if video_info.position_seconds
+            }
+            with self.lock:
+                if positions == self.written_positions:
+                    return
+                # write a copy and swap it in, so a crash mid write can't
+                # leave a truncated file
+                temp_positions_file = self.positions_file + ".tmp"
+                with open(temp_positions_file, "w") as f:
+                    json.dump(positions, f)
+                os.replace(temp_positions_file, self.positions_file)
+                self.written_positions = positions
+            logging.debug(f"Wrote {len(positions)} positions to {self.positions_file}")
+        except Exception:
+            logging.exception(f"unable to write positions to {self.positions_file}")
+
     @staticmethod
     def get_video_id(url) -> str:
         parsed_url = urlparse(url)
         video_id = parse_qs(parsed_url.query)["v"][0]
         return video_id
+
+    @staticmethod
+    def get_video_url(video_id) -> str:
+        return f"https://www.youtube.com/watch?v={video_id}"
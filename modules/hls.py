@@ -0,0 +1,95 @@
+import os
+import re
+import tempfile
+import time
+import uuid
+
+
+PLAYLIST_NAME = "index.m3u8"
+SEGMENT_NAME_PATTERN = re.compile(r"^segment_[0-9a-f]+_\d+\.ts$")
+
+
+def default_hls_dir() -> str:
+    # prefer tmpfs so segments never touch the disk
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "burger-hls")
+
+
+# writes the stream as HLS next to the rtmp output, or on its own. segment
+# names carry a prefix that is unique to each ffmpeg process, so they are never
+# reused across videos and can be cached by clients forever. segments are
+# numbered from the epoch time the process starts at so the media sequence
+# keeps going up
+class HlsOutput:
+    def __init__(self, directory: str, segment_seconds: int, list_size: int) -> None:
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.list_size = list_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def playlist_path(self) -> str:
+        return os.path.join(self.directory, PLAYLIST_NAME)
+
+    def get_segment_path(self, segment_name: str):
+        if not SEGMENT_NAME_PATTERN.match(segment_name):
+            return None
+        return os.path.join(self.directory, segment_name)
+
+    # ffmpeg deletes segments that fall out of its own playlist, but a killed
+    # process leaves its last few behind. anything older than two playlists
+    # worth of segments can't be referenced by a playlist anymore
+    def remove_stale_segments(self):
+        cutoff = time.time() - 2 * self.list_size * self.segment_seconds
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                if (
+                    SEGMENT_NAME_PATTERN.match(file_name)
+                    and os.path.getmtime(path) < cutoff
+                ):
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+
+    # ffmpeg output arguments that send a single encode to both the rtmp
+    # server and the HLS segment ring. without an rtmp url only HLS is written
+    def get_output_args(self, rtmp_stream_url: str, transcoding: bool) -> list:
+        self.remove_stale_segments()
+        segment_prefix = uuid.uuid4().hex[:12]
+        segment_path = os.path.join(self.directory, f"segment_{segment_prefix}_%d.ts")
+        hls_options = ":".join(
+            [
+                "f=hls",
+                f"hls_time={self.segment_seconds}",
+                f"hls_list_size={self.list_size}",
+                # timestamps restart with every process, so tell players
+                "hls_flags=delete_segments+omit_endlist+temp_file+discont_start",
+                "hls_start_number_source=epoch",
+                f"hls_segment_filename={segment_path}",
+                # keep the rtmp stream going if writing segments fails
+                "onfail=ignore",
+            ]
+        )
+        outputs = [f"[{hls_options}]{self.playlist_path}"]
+        output_args = ["-map", "0:v:0", "-map", "0:a:0?"]
+        if transcoding:
+            # segments can only be cut on keyframes
+            output_args += [
+                "-force_key_frames",
+                f"expr:gte(t,n_forced*{self.segment_seconds})",
+            ]
+        if rtmp_stream_url is not None:
+            # keep writing HLS if the rtmp server is down or goes away
+            outputs.insert(0, f"[f=flv:onfail=ignore]{rtmp_stream_url}")
+            if transcoding:
+                # the tee muxer can't tell the encoder which outputs need
+                # global headers, and flv does
+                output_args += ["-flags", "+global_header"]
+            else:
+                # the tee muxer has no codec tags of its own, so the mp4 tags
+                # of a copied stream reach the flv output, which rejects them.
+                # stream copy is only used for h264 and aac, so set their flv
+                # tags
+                output_args += ["-tag:v", "7", "-tag:a", "10"]
+        return output_args + ["-f", "tee", "|".join(outputs)]
@@ -0,0 +1,199 @@
+import bisect
+from dataclasses import dataclass
+import json
+import logging
+import subprocess
+
+from modules.metrics import MetricsHandler
+
+
+# the stream sent to the rtmp server is always 640x360 h264 with 44.1kHz aac
+# audio, files already in that shape can be sent as is without transcoding
+STREAM_COPY_VIDEO_CODEC = "h264"
+STREAM_COPY_AUDIO_CODEC = "aac"
+STREAM_COPY_RESOLUTION = (640, 360)
+STREAM_COPY_AUDIO_SAMPLE_RATE = 44100
+# viewers joining mid stream wait up to one keyframe interval for a picture
+STREAM_COPY_MAX_KEYFRAME_INTERVAL_SECONDS = 5
+
+# a file whose last video packet ends this far before the reported duration of
+# its video stream is considered truncated
+TRUNCATION_TOLERANCE_SECONDS = 2
+
+PROBE_TIMEOUT_SECONDS = 120
+
+
+@dataclass
+class MediaInfo:
+    duration_seconds: float
+    video_codec: str
+    audio_codec: str
+    width: int
+    height: int
+    audio_sample_rate: int
+    bit_rate: int
+    # largest gap between two keyframes
+    keyframe_interval_seconds: float
+    is_valid: bool
+    # presentation times of every video keyframe, used to seek without
+    # decoding frames we would throw away
+    keyframe_times: list = None
+
+    @property
+    def can_stream_copy(self) -> bool:
+        return (
+            self.is_valid
+            and self.video_codec == STREAM_COPY_VIDEO_CODEC
+            and self.audio_codec == STREAM_COPY_AUDIO_CODEC
+            and (self.width, self.height) == STREAM_COPY_RESOLUTION
+            and self.audio_sample_rate == STREAM_COPY_AUDIO_SAMPLE_RATE
+            and self.keyframe_interval_seconds is not None
+            and self.keyframe_interval_seconds
+            <= STREAM_COPY_MAX_KEYFRAME_INTERVAL_SECONDS
+        )
+
+    # the closest keyframe at or before the given time, so that an input
+    # seek lands exactly on it
+    def get_keyframe_before(self, seconds: float) -> float:
+        if not self.keyframe_times:
+            return seconds
+        index = bisect.bisect_right(self.keyframe_times, seconds) - 1
+        return self.keyframe_times[max(index, 0)]
+
+
+def _run_ffprobe(args: list):
+    return subprocess.run(
+        ["ffprobe", "-v", "error", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+        text=True,
+        timeout=PROBE_TIMEOUT_SECONDS,
+    )
+
+
+def _get_keyframe_times(file_path: str):
+    # reading packet flags doesn't decode anything, so this is a lot faster
+    # than asking for keyframes with -skip_frame nokey. it still reads every
+    # packet, so any damage in the file shows up on stderr
+    result = _run_ffprobe(
+        [
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "packet=pts_time,flags",
+            "-of",
+            "csv=p=0",
+            file_path,
+        ]
+    )
+    keyframe_times = []
+    last_packet_time = None
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        try:
+            packet_time = float(pts_time)
+        except ValueError:
+            continue
+        last_packet_time = packet_time
+        if "K" in flags:
+            keyframe_times.append(packet_time)
+    is_valid = result.returncode == 0 and not result.stderr.strip()
+    return sorted(keyframe_times), last_packet_time, is_valid
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# returns None if ffprobe couldn't be run at all, so callers can tell apart
+# "this file is broken" from "we don't know anything about this file"
+def probe_media(file_path: str):
+    try:
+        with MetricsHandler.media_probe_time.time():
+            result = _run_ffprobe(
+                [
+                    "-print_format",
+                    "json",
+                    "-show_format",
+                    "-show_streams",
+                    file_path,
+                ]
+            )
+            if result.returncode != 0:
+                logging.warning(
+                    f"ffprobe failed on {file_path}: {result.stderr.strip()}"
+                )
+                MetricsHandler.media_probe_count.labels(result="invalid").inc()
+                return MediaInfo(
+                    duration_seconds=None,
+                    video_codec=None,
+                    audio_codec=None,
+                    width=None,
+                    height=None,
+                    audio_sample_rate=None,
+                    bit_rate=None,
+                    keyframe_interval_seconds=None,
+                    is_valid=False,
+                    keyframe_times=[],
+                )
+            probe = json.loads(result.stdout)
+            keyframe_times, last_packet_time, packets_valid = _get_keyframe_times(
+                file_path
+            )
+    except (OSError, subprocess.TimeoutExpired, json.JSONDecodeError):
+        logging.exception(f"unable to probe {file_path}")
+        return None
+
+    streams = probe.get("streams", [])
+    video_stream = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), {})
+    media_format = probe.get("format", {})
+
+    try:
+        duration_seconds = float(media_format["duration"])
+    except (KeyError, ValueError):
+        duration_seconds = None
+    # the format duration is that of the longest stream, which can be the
+    # audio, so check the video packets against the video stream's own
+    # duration where the container reports one
+    try:
+        video_duration_seconds = float(video_stream["duration"])
+    except (KeyError, ValueError):
+        video_duration_seconds = duration_seconds
+
+    keyframe_interval_seconds = None
+    if len(keyframe_times) > 1:
+        keyframe_interval_seconds = max(
+            b - a for a, b in zip(keyframe_times, keyframe_times[1:])
+        )
+
+    is_valid = (
+        packets_valid
+        and bool(video_stream)
+        and bool(keyframe_times)
+        and duration_seconds is not None
+        and duration_seconds > 0
+        and last_packet_time is not None
+        and video_duration_seconds is not None
+        and last_packet_time >= video_duration_seconds - TRUNCATION_TOLERANCE_SECONDS
+    )
+    MetricsHandler.media_probe_count.labels(
+        result="valid" if is_valid else "invalid"
+    ).inc()
+
+    return MediaInfo(
+        duration_seconds=duration_seconds,
+        video_codec=video_stream.get("codec_name"),
+        audio_codec=audio_stream.get("codec_name"),
+        width=_to_int(video_stream.get("width")),
+        height=_to_int(video_stream.get("height")),
+        audio_sample_rate=_to_int(audio_stream.get("sample_rate")),
+        bit_rate=_to_int(media_format.get("bit_rate")),
+        keyframe_interval_seconds=keyframe_interval_seconds,
+        is_valid=is_valid,
+        keyframe_times=keyframe_times,
+    )
@@ -66,13 +66,65 @@ class Metrics(enum.Enum):
         prometheus_client.Counter,
     )
 
+    MEDIA_PROBE_TIME = (
+        "media_probe_time",
+        "Total time spent probing cached videos with ffprobe in seconds",
+        prometheus_client.Summary,
+    )
+
+    MEDIA_PROBE_COUNT = (
+        "media_probe_count",
+        "Number of cached videos probed with ffprobe",
+        prometheus_client.Counter,
+        ["result"],  # valid, invalid
+    )
+
     HTTP_REQUEST_COUNT = (
         "http_request_count",
-        "Number of requests received for each endpoint",
+        "Number of requests received for each route template",
         prometheus_client.Counter,
         ["endpoint"],
     )
 
+    HTTP_REQUEST_DURATION = (
+        "http_request_duration_seconds",
+        "Time spent handling requests in seconds for each route template",
+        prometheus_client.Histogram,
+        ["endpoint", "method"],
+    )
+
+    HTTP_RESPONSE_COUNT = (
+        "http_response_count",
+        "Number of responses sent for each route template and status class",
+        prometheus_client.Counter,
+        ["endpoint", "status_class"],  # 2xx, 4xx, 5xx etc
+    )
+
+    HTTP_REQUESTS_IN_FLIGHT = (
+        "http_requests_in_flight",
+        "Number of requests currently being handled",
+        prometheus_client.Gauge,
+    )
+
+    EVENT_LOOP_LAG = (
+        "event_loop_lag_seconds",
+        "How late the event loop woke up a periodic probe in seconds",
+        prometheus_client.Histogram,
+    )
+
+    THREAD_COUNT = (
+        "thread_count",
+        "Number of live threads in the server process",
+        prometheus_client.Gauge,
+    )
+
+    STARTUP_PHASE_SECONDS = (
+        "startup_phase_seconds",
+        "Time taken by each phase of server startup in seconds",
+        prometheus_client.Gauge,
+        ["phase"],  # import, serving, cache_load, cache_reconcile
+    )
+
     def __init__(self, title, description, prometheus_type, labels=()):
         # we use the above default value for labels because it matches what's used
         # in the prometheus_client library's metrics constructor, see
@@ -0,0 +1,63 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import logging
+
+
+# number of upcoming playlist items whose metadata is fetched in parallel
+PREFETCH_COUNT = 4
+
+
+@dataclass
+class PlaylistEntry:
+    url: str
+    title: str
+    thumbnail: str
+
+
+def _resolve_entry(url: str):
+    from pytubefix import YouTube
+
+    video = YouTube(url)
+    # Only play age-unrestricted videos to avoid exceptions
+    if video.age_restricted:
+        logging.info(f"skipping age restricted video {url}")
+        return None
+    return PlaylistEntry(url=url, title=video.title, thumbnail=video.thumbnail_url)
+
+
+def _take_resolved(url, future):
+    try:
+        return future.result()
+    except Exception:
+        logging.exception(f"unable to get metadata for {url}, skipping it")
+        return None
+
+
+# yield playable entries of a playlist in order as its pages are fetched,
+# instead of enumerating the whole playlist up front. metadata for the next
+# few items is resolved in parallel so restricted or broken items are
+# skipped before it is their turn to play
+def iterate_playlist(playlist_url: str, prefetch_count: int = PREFETCH_COUNT):
+    from pytubefix import Playlist
+
+    urls = Playlist(playlist_url).url_generator()
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(
+        max_workers=prefetch_count,
+        thread_name_prefix="playlist-prefetch",
+    )
+    try:
+        for url in urls:
+            pending.append((url, executor.submit(_resolve_entry, url)))
+            if len(pending) < prefetch_count:
+                continue
+            entry = _take_resolved(*pending.popleft())
+            if entry is not None:
+                yield entry
+        while pending:
+            entry = _take_resolved(*pending.popleft())
+            if entry is not None:
+                yield entry
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
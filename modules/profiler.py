@@ -0,0 +1,75 @@
+import collections
+import contextlib
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+
+
+# sample every thread's stack at a fixed interval for the given duration and
+# return the result in collapsed stack format, i.e. one line per unique stack
+# of the form "thread;outer_func;inner_func count". this is the input format
+# for flamegraph.pl, speedscope and friends
+def sample_stacks(seconds: float, interval: float = 0.01) -> str:
+    stack_counts = collections.Counter()
+    sampler_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            # skip our own stack, it is always just this loop
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            stack_counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in stack_counts.most_common())
+
+
+# wraps a cProfile capture of a single request. while not armed, profile()
+# returns a no-op context so there is no overhead outside of a capture
+class RequestProfiler:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.armed = False
+        self.result = None
+
+    def arm(self):
+        with self.lock:
+            self.armed = True
+
+    def _take_armed(self):
+        with self.lock:
+            armed = self.armed
+            self.armed = False
+            return armed
+
+    def profile(self):
+        if not self._take_armed():
+            return contextlib.nullcontext()
+        return _ProfileContext(self)
+
+
+class _ProfileContext:
+    def __init__(self, request_profiler: RequestProfiler) -> None:
+        self.request_profiler = request_profiler
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.sort_stats("cumulative").print_stats(50)
+        self.request_profiler.result = output.getvalue()
+        return False
@@ -1,29 +1,38 @@
+import asyncio
+from dataclasses import asdict
 import enum
+import hmac
+import importlib
 import os
 import json
+import math
 import subprocess
 import threading
-from urllib.parse import unquote
+from urllib.parse import parse_qs, unquote, urlparse
 import uvicorn
 import signal
 import logging
 import ssl
 import time
 
+# measured from here for the startup_phase_seconds metric
+import_start_time = time.perf_counter()
+
 ssl._create_default_https_context = ssl._create_stdlib_context
 
 from fastapi import FastAPI, HTTPException, Response, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pytubefix import YouTube, Playlist
-import pytubefix.exceptions
+from starlette.routing import Match
 import prometheus_client
-import psutil
 
 from modules.args import get_args
 from modules.cache import Cache
+from modules.hls import HlsOutput, default_hls_dir
 from modules.metrics import MetricsHandler
+from modules.playlist import iterate_playlist
+from modules.profiler import RequestProfiler, sample_stacks
 
 
 logging.Formatter.converter = time.gmtime
@@ -59,11 +68,23 @@ current_video_dict = {}
 
 interlude_lock = threading.Lock()
 
+# Used to capture a cProfile of the next /play request when armed through /debug/profile/play
+play_profiler = RequestProfiler()
+
 args = get_args()
 
 # Create a cache object to store video files, initializing it with the file path specified in the command-line arguments or configuration settings. This instance is used to cache downloaded videos.
 video_cache = Cache(file_path=args.videopath, cache_file=args.cache_state_file)
 
+# Write the stream as HLS alongside the rtmp stream if enabled
+hls_output = None
+if args.hls:
+    hls_output = HlsOutput(
+        directory=args.hls_dir or default_hls_dir(),
+        segment_seconds=args.hls_segment_seconds,
+        list_size=args.hls_list_size,
+    )
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -74,10 +95,56 @@ app.add_middleware(
 )
 
 
+# how often the event loop lag probe wakes up, in seconds
+EVENT_LOOP_LAG_PROBE_INTERVAL = 0.5
+
+# how often the position of a playing video is recorded, in seconds
+PLAYBACK_POSITION_SAVE_INTERVAL = 15
+
+
+# label requests by the route they matched rather than the raw path, since
+# raw paths can contain user input and would blow up metric cardinality
+def _get_route_template(request: Request):
+    for route in request.app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            # the static files mount at "/" has an empty path
+            return route.path or "static"
+    return "unmatched"
+
+
 @app.middleware("http")
-async def http_request_count(request: Request, call_next):
-    MetricsHandler.http_request_count.labels(endpoint=request.url.path).inc()
-    return await call_next(request)
+async def http_request_metrics(request: Request, call_next):
+    endpoint = _get_route_template(request)
+    MetricsHandler.http_request_count.labels(endpoint=endpoint).inc()
+    status_code = 500
+    start = time.perf_counter()
+    try:
+        with MetricsHandler.http_requests_in_flight.track_inprogress():
+            response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        MetricsHandler.http_request_duration_seconds.labels(
+            endpoint=endpoint,
+            method=request.method,
+        ).observe(time.perf_counter() - start)
+        MetricsHandler.http_response_count.labels(
+            endpoint=endpoint,
+            status_class=f"{status_code // 100}xx",
+        ).inc()
+
+
+# sleep for a fixed interval and record how much later than expected we woke
+# up. anything blocking the event loop (i.e. a sync call in an async endpoint)
+# shows up as lag
+async def probe_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_PROBE_INTERVAL)
+        lag = loop.time() - start - EVENT_LOOP_LAG_PROBE_INTERVAL
+        MetricsHandler.event_loop_lag_seconds.observe(max(lag, 0))
 
 
 # return the result of process.wait()
@@ -88,6 +155,8 @@ def create_ffmpeg_stream(
     title=None,
     thumbnail=None,
     play_interlude_after=False,
+    media=None,
+    start_seconds=0,
 ):
     if video_path is None:
         logging.info("video_path is None. ffmpeg_stream cancelled.")
@@ -114,6 +183,23 @@ def create_ffmpeg_stream(
         "flv",
         args.rtmp_stream_url,
     ]
+    # Skip transcoding if the cached file is already in the shape we stream
+    stream_copy = media is not None and media.can_stream_copy
+    if stream_copy:
+        command[4:16] = ["-c", "copy"]
+    if hls_output is not None:
+        command[-3:] = hls_output.get_output_args(
+            args.rtmp_stream_url, transcoding=not stream_copy
+        )
+    # Seek on the input side to the keyframe at or before the start, so
+    # ffmpeg doesn't decode everything up to the requested position first
+    if start_seconds > 0:
+        if media is not None:
+            start_seconds = media.get_keyframe_before(start_seconds)
+        # round up, a value just below the keyframe would seek to the one
+        # before it and play a whole extra group of pictures first
+        start_seconds = math.ceil(start_seconds * 1000) / 1000
+        command[2:2] = ["-ss", f"{start_seconds:.3f}"]
     # Loop the interlude stream
     if loop:
         command[2:2] = ["-stream_loop", "-1"]
@@ -123,6 +209,7 @@ def create_ffmpeg_stream(
         stdin=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
     )
+    stream_start_time = time.monotonic()
 
     if None not in [title, thumbnail]:
         current_video_dict["title"] = title
@@ -132,7 +219,19 @@ def create_ffmpeg_stream(
     MetricsHandler.streams_count.labels(video_type=video_type.value).inc(amount=1)
     # the below function returns 0 if the video ended on its own
     # 137, 1
-    exit_code = process.wait()
+    while True:
+        try:
+            exit_code = process.wait(timeout=PLAYBACK_POSITION_SAVE_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            # record progress as we go, so it survives a crash and /list
+            # shows where the video is
+            if video_type == State.PLAYING:
+                save_playback_position(
+                    video_path,
+                    start_seconds + time.monotonic() - stream_start_time,
+                    finished=False,
+                )
     logging.info(f"process {process.pid} exited with code {exit_code}")
     MetricsHandler.subprocess_count.labels(
         exit_code=exit_code,
@@ -140,6 +239,14 @@ def create_ffmpeg_stream(
     if video_type in process_dict:
         process_dict.pop(video_type)
     current_video_dict.clear()
+    if video_type == State.PLAYING:
+        # with -re the file is read in real time, so the time spent streaming
+        # is how far into the video we got
+        save_playback_position(
+            video_path,
+            start_seconds + time.monotonic() - stream_start_time,
+            finished=exit_code == 0,
+        )
 
     if exit_code == 0 and play_interlude_after and args.interlude:
         interlude_lock.release()
@@ -147,6 +254,31 @@ def create_ffmpeg_stream(
     return exit_code
 
 
+# remember where playback of a cached video got to so it can be resumed, and
+# write it out right away so it isn't lost if we are killed
+def save_playback_position(video_path: str, position_seconds: float, finished: bool):
+    video_info = video_cache.find_by_path(video_path)
+    if video_info is None:
+        return
+    if finished:
+        position_seconds = 0
+    elif video_info.media is not None and video_info.media.duration_seconds:
+        # looping videos keep going past the end
+        position_seconds %= video_info.media.duration_seconds
+    video_info.position_seconds = position_seconds
+    # writing a partially read cache would drop the entries not read yet
+    if args.cache_state_file and video_cache.loaded.is_set():
+        video_cache.write_positions()
+
+
+# where to start a cached video from, given the start offset and resume flag
+# passed to /play or /play/file
+def _get_start_seconds(video_info, start: float, resume: bool):
+    if resume and video_info is not None:
+        return video_info.position_seconds
+    return start
+
+
 # stop the video by type
 def stop_video_by_type(video_type: State):
     if video_type in process_dict:
@@ -161,6 +293,8 @@ def stop_all_videos():
 
 # terminate a parent process and all its child processes using a specified signal.
 def kill_child_processes(parent_pid, sig=signal.SIGKILL):
+    import psutil
+
     try:
         parent = psutil.Process(parent_pid)
         parent.send_signal(sig)
@@ -181,22 +315,44 @@ def handle_interlude():
         create_ffmpeg_stream(args.interlude, State.INTERLUDE, loop=True)
 
 
-def download_next_video_in_list(playlist, current_index):
-    next_index = current_index + 1
-    if next_index == (len(playlist)):
-        next_index = 0
-    video_url = playlist[next_index]
-    if video_cache.find(Cache.get_video_id(video_url)) is None:
-        video_cache.add(video_url)
+def _next_playlist_entry(entries):
+    try:
+        return next(entries, None)
+    except Exception:
+        logging.exception("unable to get the next video in playlist")
+        return None
+
+
+# take the next entry off the playlist iterator and download it, so it is
+# ready by the time the current video ends. the entry is handed back through
+# next_entry since this runs on its own thread
+def download_next_video_in_list(entries, next_entry: list):
+    entry = _next_playlist_entry(entries)
+    next_entry.append(entry)
+    if entry is None:
+        return
+    if video_cache.find(Cache.get_video_id(entry.url)) is None:
+        video_cache.add(entry.url)
 
 
 def download_and_play_video(
-    url, loop, title=None, thumbnail=None, play_interlude_after=True
+    url,
+    loop,
+    title=None,
+    thumbnail=None,
+    play_interlude_after=True,
+    start=0,
+    resume=False,
 ):
-    video_path = video_cache.find(Cache.get_video_id(url))
+    video_id = Cache.get_video_id(url)
+    video_path = video_cache.find(video_id)
+    # a corrupt file is dropped from the cache and downloaded again below
+    if video_path is not None and not video_cache.ensure_valid(video_id):
+        video_path = None
     if video_path is None:
         video_cache.add(url)
-        video_path = video_cache.find(Cache.get_video_id(url))
+        video_path = video_cache.find(video_id)
+    video_info = video_cache.find_by_path(video_path)
     stop_all_videos()
     return create_ffmpeg_stream(
         video_path,
@@ -205,42 +361,82 @@ def download_and_play_video(
         title,
         thumbnail,
         play_interlude_after=play_interlude_after,
+        media=video_info.media if video_info else None,
+        start_seconds=_get_start_seconds(video_info, start, resume),
+    )
+
+
+# urls like watch?v=...&list=RD... parse as playlists, but the list itself may
+# not be fetchable, i.e. mixes or private and deleted lists. play the video the
+# url points at instead, if there is one
+def play_playlist_url_as_video(playlist_url: str, loop: bool, resume: bool):
+    from pytubefix import YouTube
+
+    if "v" not in parse_qs(urlparse(playlist_url).query):
+        logging.error(f"playlist {playlist_url} has no videos to play")
+        if args.interlude:
+            interlude_lock.release()
+        return
+    logging.info(f"playing {playlist_url} as a single video instead")
+    video = YouTube(playlist_url)
+    download_and_play_video(
+        playlist_url, loop, video.title, video.thumbnail_url, resume=resume
     )
 
 
-def handle_playlist(playlist_url: str, loop: bool):
-    playlist = Playlist(playlist_url)
-    # Stop interlude
+def handle_playlist(playlist_url: str, loop: bool, resume: bool = False):
+    try:
+        play_playlist(playlist_url, loop, resume)
+    except Exception:
+        # make sure the interlude comes back if the routine dies
+        logging.exception(f"playlist routine for {playlist_url} failed, exiting")
+        if args.interlude:
+            interlude_lock.release()
+
+
+def play_playlist(playlist_url: str, loop: bool, resume: bool = False):
+    first_pass = True
     while True:
-        for i in range(len(playlist)):
-            video_url = playlist[i]
-            video = YouTube(video_url)
-            # Only play age-unrestricted videos to avoid exceptions
-            if not video.age_restricted:
-                t = threading.Thread(
-                    target=download_next_video_in_list,
-                    args=(playlist, i),
-                    daemon=True,
-                )
-                t.start()
-                result = download_and_play_video(
-                    video_url,
-                    loop=False,
-                    title=video.title,
-                    thumbnail=video.thumbnail_url,
-                    play_interlude_after=False,
-                )
+        entries = iterate_playlist(playlist_url)
+        entry = _next_playlist_entry(entries)
+        if entry is None:
+            if first_pass:
+                play_playlist_url_as_video(playlist_url, loop, resume)
+                return
+            # the playlist can't be fetched anymore, don't spin trying
+            logging.info(f"playlist {playlist_url} has no videos left, exiting")
+            if args.interlude:
+                interlude_lock.release()
+            return
+        first_pass = False
+        while entry is not None:
+            next_entry = []
+            t = threading.Thread(
+                target=download_next_video_in_list,
+                args=(entries, next_entry),
+                daemon=True,
+            )
+            t.start()
+            result = download_and_play_video(
+                entry.url,
+                loop=False,
+                title=entry.title,
+                thumbnail=entry.thumbnail,
+                play_interlude_after=False,
+                resume=resume,
+            )
             if result == 2:
                 logging.info(
-                    f"Video {video_url} failed to download, skipping to next video in playlist"
+                    f"Video {entry.url} failed to download, skipping to next video in playlist"
                 )
-                continue
-            if result != 0:
+            elif result != 0:
                 # exit the entire thread routine if the video we just played was killed
                 logging.info(f"playlist routine recieved code {result}, exiting")
                 if args.interlude:
                     interlude_lock.release()
                 return
+            t.join()
+            entry = next_entry[0] if next_entry else None
         if not loop:
             if args.interlude:
                 interlude_lock.release()
@@ -248,9 +444,12 @@ def handle_playlist(playlist_url: str, loop: bool):
 
 
 def _get_url_type(url: str):
+    import pytubefix
+
     try:
-        playlist = pytubefix.Playlist(url)
-        logging.debug(f"{url} is a playlist with {len(playlist)} videos")
+        # only parses the url, playlist pages are fetched once we start playing
+        playlist_id = pytubefix.Playlist(url).playlist_id
+        logging.debug(f"{url} is a playlist with id {playlist_id}")
         return UrlType.PLAYLIST
     except:
         try:
@@ -261,12 +460,15 @@ def _get_url_type(url: str):
             return UrlType.UNKNOWN
 
 
-def handle_cache_play():
+def handle_cache_play(resume: bool = False):
     # Get all the videos in the cache
-    cache_videos = video_cache.video_id_to_path
+    cache_videos = video_cache.get_items()
 
     # Loop through each video in the cache
-    for _, video in cache_videos.items():
+    for video_id, video in cache_videos.items():
+        # Skip videos that turn out to be corrupt
+        if not video_cache.ensure_valid(video_id):
+            continue
 
         # Store the current playing video information
         current_video_dict["title"] = video.title
@@ -280,6 +482,8 @@ def handle_cache_play():
             loop=False,
             title=video.title,
             thumbnail=video.thumbnail,
+            media=video.media,
+            start_seconds=_get_start_seconds(video, 0, resume),
         )
 
         # if the video ended on its own, continue to the next video, otherwise break out of the loop
@@ -296,7 +500,28 @@ async def state():
 
 
 @app.post("/play/file")
-async def play_file(file_path: str = "cache", title: str = None, thumbnail: str = None):
+async def play_file(
+    file_path: str = "cache",
+    title: str = None,
+    thumbnail: str = None,
+    start: float = 0,
+    resume: bool = False,
+):
+    if start < 0:
+        raise HTTPException(status_code=400, detail="start can't be negative")
+    # a start offset only makes sense for one video, resume works per video
+    if file_path == "cache" and start > 0:
+        raise HTTPException(
+            status_code=400, detail="start can only be used with a single video"
+        )
+
+    # Refuse to play a cached video that turns out to be corrupt. probing can
+    # take a moment, so keep it off the event loop
+    video_id = video_cache.get_video_id_by_path(file_path)
+    if video_id is not None and not await asyncio.to_thread(
+        video_cache.ensure_valid, video_id
+    ):
+        raise HTTPException(status_code=400, detail="This video is corrupt :(")
 
     # If any video playing, stop it
     for video_type in State:
@@ -310,10 +535,11 @@ async def play_file(file_path: str = "cache", title: str = None, thumbnail: str
         if file_path == "cache":
 
             # Start a thread to play all videos in the cache
-            threading.Thread(target=handle_cache_play).start()
+            threading.Thread(target=handle_cache_play, args=(resume,)).start()
 
         else:
             # Start a thread to play a single video in the cache
+            video_info = video_cache.find_by_path(file_path)
             threading.Thread(
                 target=create_ffmpeg_stream,
                 args=(
@@ -323,6 +549,10 @@ async def play_file(file_path: str = "cache", title: str = None, thumbnail: str
                     title,
                     thumbnail,
                 ),
+                kwargs={
+                    "media": video_info.media if video_info else None,
+                    "start_seconds": _get_start_seconds(video_info, start, resume),
+                },
             ).start()
 
         return {"detail": "Success"}
@@ -338,55 +568,80 @@ async def play_file(file_path: str = "cache", title: str = None, thumbnail: str
 
 
 @app.post("/play")
-async def play(url: str, loop: bool = False):
+async def play(url: str, loop: bool = False, start: float = 0, resume: bool = False):
+    from pytubefix import YouTube
+    import pytubefix.exceptions
+
+    if start < 0:
+        raise HTTPException(status_code=400, detail="start can't be negative")
+
     # Decode URL
     url = unquote(url)
 
-    # Start thread to download video, stream it, and provide a response
-    try:
+    # Capture a profile of this request if one was requested through /debug/profile/play
+    with play_profiler.profile():
+        # Start thread to download video, stream it, and provide a response
+        try:
 
-        # Get the type of URL (VIDEO, PLAYLIST, UNKNOWN)
-        url_type = _get_url_type(url)
-        logging.info(f"{url} is a {url_type}")
+            # Get the type of URL (VIDEO, PLAYLIST, UNKNOWN)
+            url_type = _get_url_type(url)
+            logging.info(f"{url} is a {url_type}")
 
-        # Check the type of URL and start the appropriate thread
-        if url_type == UrlType.VIDEO:
-            video = YouTube(url)
-            t = threading.Thread(
-                target=download_and_play_video,
-                args=(url, loop, video.title, video.thumbnail_url),
-            )
-            t.start()
-
-        elif url_type == UrlType.PLAYLIST:
-            t = threading.Thread(
-                target=handle_playlist,
-                args=(url, loop),
-            )
-            t.start()
+            # Check the type of URL and start the appropriate thread
+            if url_type == UrlType.VIDEO:
+                video = YouTube(url)
+                t = threading.Thread(
+                    target=download_and_play_video,
+                    args=(url, loop, video.title, video.thumbnail_url),
+                    kwargs={"start": start, "resume": resume},
+                )
+                t.start()
 
-        else:
-            raise HTTPException(status_code=400, detail="given url is of unknown type")
-        # Update Metrics
-        MetricsHandler.video_count.inc()
-        return {"detail": "Success"}
+            elif url_type == UrlType.PLAYLIST:
+                # a start offset only makes sense for one video, resume works
+                # per video
+                if start > 0:
+                    raise HTTPException(
+                        status_code=400,
+                        detail="start can only be used with a single video",
+                    )
+                t = threading.Thread(
+                    target=handle_playlist,
+                    args=(url, loop, resume),
+                )
+                t.start()
 
-    # If download is unsuccessful, give response and reason
-    except pytubefix.exceptions.AgeRestrictedError:
-        raise HTTPException(status_code=400, detail="This video is age restricted :(")
-    except pytubefix.exceptions.RegexMatchError:
-        raise HTTPException(
-            status_code=400, detail="That's not a YouTube link buddy ..."
-        )
-    except pytubefix.exceptions.VideoUnavailable:
-        raise HTTPException(status_code=404, detail="This video is unavailable :(")
-    except Exception as e:
-        logging.exception(e)
-        raise HTTPException(status_code=500, detail="check logs")
+            else:
+                raise HTTPException(
+                    status_code=400, detail="given url is of unknown type"
+                )
+            # Update Metrics
+            MetricsHandler.video_count.inc()
+            return {"detail": "Success"}
+
+        # If download is unsuccessful, give response and reason
+        except pytubefix.exceptions.AgeRestrictedError:
+            raise HTTPException(
+                status_code=400, detail="This video is age restricted :("
+            )
+        except pytubefix.exceptions.RegexMatchError:
+            raise HTTPException(
+                status_code=400, detail="That's not a YouTube link buddy ..."
+            )
+        except pytubefix.exceptions.VideoUnavailable:
+            raise HTTPException(status_code=404, detail="This video is unavailable :(")
+        except HTTPException:
+            raise
+        except Exception as e:
+            logging.exception(e)
+            raise HTTPException(status_code=500, detail="check logs")
 
 
 @app.get("/metadata")
 def metadata(url: str):
+    from pytubefix import YouTube, Playlist
+    import pytubefix.exceptions
+
     url = unquote(url)
     try:
         url_type = _get_url_type(url)
@@ -424,16 +679,27 @@ async def stop():
         stop_video_by_type(State.PLAYING)
 
 
+def _get_media_summary(media):
+    if media is None:
+        return None
+    summary = asdict(media)
+    # the keyframe index is only needed for seeking and can be large
+    summary.pop("keyframe_times")
+    return summary
+
+
 @app.get("/list")
 async def getVideos():
     returnedResponse = []
-    for key, value in video_cache.video_id_to_path.items():
+    for key, value in video_cache.get_items().items():
         returnedResponse.append(
             {
                 "id": key,
                 "name": value.title,
                 "path": value.file_path,
                 "thumbnail": value.thumbnail,
+                "media": _get_media_summary(value.media),
+                "position_seconds": value.position_seconds,
             }
         )
     return json.dumps(returnedResponse)
@@ -447,6 +713,35 @@ def get_metrics():
     )
 
 
+@app.get("/hls/index.m3u8")
+def get_hls_playlist():
+    if hls_output is None or not os.path.exists(hls_output.playlist_path):
+        raise HTTPException(status_code=404, detail="no HLS stream available")
+    # the playlist changes every segment, let clients and proxies reuse it for
+    # half a segment so they don't all hit us at once
+    max_age = max(hls_output.segment_seconds // 2, 1)
+    return FileResponse(
+        hls_output.playlist_path,
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": f"public, max-age={max_age}"},
+    )
+
+
+@app.get("/hls/{segment_name}")
+def get_hls_segment(segment_name: str):
+    if hls_output is None:
+        raise HTTPException(status_code=404, detail="no HLS stream available")
+    segment_path = hls_output.get_segment_path(segment_name)
+    if segment_path is None or not os.path.exists(segment_path):
+        raise HTTPException(status_code=404, detail="segment not found")
+    return FileResponse(
+        segment_path,
+        media_type="video/mp2t",
+        # segment names are never reused, so they can be cached forever
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
 @app.get("/cache")
 def get_cache():
     return FileResponse("static/cache.html")
@@ -459,51 +754,135 @@ def debug():
             "process_dict": process_dict,
             "current_video_dict": current_video_dict,
         },
-        "cache": vars(video_cache),
+        # built explicitly since the cache also holds threading primitives
+        # that can't be serialized
+        "cache": {
+            "file_path": video_cache.file_path,
+            "max_size_bytes": video_cache.max_size_bytes,
+            "current_size_bytes": video_cache.current_size_bytes,
+            "cache_file": video_cache.cache_file,
+            "loaded": video_cache.loaded.is_set(),
+            "video_id_to_path": video_cache.get_items(),
+        },
     }
 
 
-@app.on_event("shutdown")
-def signal_handler():
-    stop_all_videos()
+def _check_debug_token(request: Request):
+    if not args.debug_token:
+        raise HTTPException(status_code=404, detail="debug profiling is disabled")
+    # compare as bytes since compare_digest rejects non-ascii str, and
+    # starlette decodes headers as latin-1
+    authorization = request.headers.get("Authorization", "").encode("latin-1")
+    expected = f"Bearer {args.debug_token}".encode()
+    if not hmac.compare_digest(authorization, expected):
+        raise HTTPException(status_code=401, detail="invalid debug token")
 
-    # if the cache file is specfied, write the cache to the file and not clear the downloaded videos
-    if args.cache_state_file:
-        video_cache.write_cache()
 
-    # if the cache file isn't specified, clear all uncache videos
-    else:
-        video_cache.clear()
+@app.get("/debug/profile")
+def debug_profile(request: Request, seconds: float = 5, interval: float = 0.01):
+    _check_debug_token(request)
+    if not 0 < seconds <= args.profile_max_seconds:
+        raise HTTPException(
+            status_code=400,
+            detail=f"seconds must be between 0 and {args.profile_max_seconds}",
+        )
+    # this endpoint is sync so the sampling runs on a threadpool worker and
+    # the event loop thread shows up in the samples like any other thread
+    return PlainTextResponse(sample_stacks(seconds, interval=max(interval, 0.001)))
 
 
-app.mount("/", StaticFiles(directory="static", html=True), name="static")
+@app.post("/debug/profile/play")
+def arm_play_profile(request: Request):
+    _check_debug_token(request)
+    play_profiler.arm()
+    return {"detail": "the next /play request will be profiled"}
 
 
-# we have a separate __name__ check here due to how FastAPI starts
-# a server. the file is first ran (where __name__ == "__main__")
-# and then calls `uvicorn.run`. the call to run() reruns the file,
-# this time __name__ == "server". the separate __name__ if statement
-# is so a thread starts up the interlude after the server is ready to go
-if __name__ == "server":
+@app.get("/debug/profile/play")
+def get_play_profile(request: Request):
+    _check_debug_token(request)
+    if play_profiler.result is None:
+        raise HTTPException(status_code=404, detail="no /play request profiled yet")
+    return PlainTextResponse(play_profiler.result)
+
+
+# read the cache file and probe its entries off the event loop, so requests
+# are served and the interlude is on air while the cache warms up
+def warm_up_cache():
+    # pay for the imports only needed once something is played here rather
+    # than on the first request
+    importlib.import_module("psutil")
+    importlib.import_module("pytubefix")
+
+    # if the cache file is specified, populate the cache from the file
+    if not args.cache_state_file:
+        return
+    with MetricsHandler.startup_phase_seconds.labels(phase="cache_load").time():
+        video_cache.populate_cache()
+    # probe entries from older cache files
+    with MetricsHandler.startup_phase_seconds.labels(phase="cache_reconcile").time():
+        video_cache.probe_unindexed()
+
+
+@app.on_event("startup")
+async def startup():
     MetricsHandler.init()
+    MetricsHandler.startup_phase_seconds.labels(phase="import").set(app_import_seconds)
+    MetricsHandler.thread_count.set_function(threading.active_count)
     MetricsHandler.cache_size.set(0)
     MetricsHandler.cache_size_bytes.set(0)
     # Start up interlude by default
     if args.interlude:
-        threading.Thread(target=handle_interlude).start()
+        threading.Thread(target=handle_interlude, daemon=True).start()
     # Ensure video folder exists
     if not os.path.exists(args.videopath):
         os.makedirs(args.videopath)
 
-    # if the cache file is specified, populate the cache from the file
+    threading.Thread(target=warm_up_cache, daemon=True).start()
+
+    # keep a reference so the task isn't garbage collected
+    app.state.event_loop_lag_probe = asyncio.create_task(probe_event_loop_lag())
+    MetricsHandler.startup_phase_seconds.labels(phase="serving").set(
+        time.perf_counter() - import_start_time
+    )
+
+
+@app.on_event("shutdown")
+def signal_handler():
+    stop_all_videos()
+
+    # if the cache file is specfied, write the cache to the file and not clear the downloaded videos
     if args.cache_state_file:
-        video_cache.populate_cache()
+        # writing a partially read cache would drop the entries not read yet
+        if video_cache.loaded.is_set():
+            video_cache.write_cache()
+        else:
+            logging.info("cache file was still being read, not overwriting it")
+
+    # if the cache file isn't specified, clear all uncache videos
+    else:
+        video_cache.clear()
+
+
+app.mount("/", StaticFiles(directory="static", html=True), name="static")
+
+app_import_seconds = time.perf_counter() - import_start_time
 
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "server:app",
-        host=args.host,
-        port=args.port,
-        reload=True,
-    )
+    # reloading needs uvicorn to import the app itself in a separate process,
+    # which runs this file a second time. otherwise hand it the app we already
+    # have so startup only happens once
+    if args.reload:
+        uvicorn.run(
+            "server:app",
+            host=args.host,
+            port=args.port,
+            reload=True,
+        )
+    else:
+        uvicorn.run(
+            app,
+            host=args.host,
+            port=args.port,
+        )